@@ -8,3 +8,14 @@ class CoreConfig(AppConfig):
     def ready(self):
         # Importar señales para que se registren al iniciar la app.
         from . import signals  # noqa: F401
+
+        # Precalentar el resolver de URLs: compilar los patrones y el mapa de
+        # reverse en el arranque saca ese costo del primer request.
+        from django.urls import get_resolver
+
+        try:
+            get_resolver()._populate()
+        except Exception:
+            # Si el URLconf todavía no puede importarse (comandos tempranos,
+            # settings parciales) el resolver se calienta en el primer uso.
+            pass
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.5 on 2026-08-29 08:47
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Core', '0015_alter_cita_veterinario_alter_farmaco_id_and_more'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='cita',
+            index=models.Index(fields=['sucursal', 'estado', '-fecha_solicitada'], name='Core_cita_sucursa_0c31d2_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cita',
+            index=models.Index(fields=['veterinario', '-fecha_hora'], name='Core_cita_veterin_a56af6_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cita',
+            index=models.Index(fields=['paciente', '-fecha_hora'], name='Core_cita_pacient_8b1534_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='cita',
+            index=models.Index(condition=models.Q(('veterinario__isnull', True)), fields=['estado'], name='cita_pending_no_vet'),
+        ),
+    ]
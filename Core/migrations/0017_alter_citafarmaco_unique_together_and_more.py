@@ -0,0 +1,21 @@
+# Generated by Django 5.2.5 on 2026-08-29 08:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Core', '0016_cita_core_cita_sucursa_0c31d2_idx_and_more'),
+    ]
+
+    operations = [
+        migrations.AlterUniqueTogether(
+            name='citafarmaco',
+            unique_together=set(),
+        ),
+        migrations.AddConstraint(
+            model_name='citafarmaco',
+            constraint=models.UniqueConstraint(fields=('cita', 'farmaco'), name='uniq_citafarmaco'),
+        ),
+    ]
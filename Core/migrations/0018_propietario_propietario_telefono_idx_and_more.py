@@ -0,0 +1,22 @@
+# Generated by Django 5.2.5 on 2026-08-29 09:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('Core', '0017_alter_citafarmaco_unique_together_and_more'),
+        ('auth', '0012_alter_user_first_name_max_length'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='propietario',
+            index=models.Index(fields=['telefono'], name='propietario_telefono_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='user',
+            index=models.Index(fields=['telefono'], name='user_telefono_idx'),
+        ),
+    ]
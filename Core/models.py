@@ -46,6 +46,13 @@ class User(AbstractUser):
         related_name="usuarios",
     )
 
+    class Meta(AbstractUser.Meta):
+        indexes = [
+            # La validación de teléfono duplicado corre en cada guardado de
+            # perfil y registro; el índice evita el escaneo completo.
+            models.Index(fields=["telefono"], name="user_telefono_idx"),
+        ]
+
     def __str__(self):
         return f"{self.username} ({self.get_rol_display()})"
 
@@ -59,6 +66,11 @@ class Propietario(models.Model):
     ciudad = models.CharField(max_length=100, blank=True)
     notas = models.TextField(blank=True)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=["telefono"], name="propietario_telefono_idx"),
+        ]
+
     def __str__(self):
         return self.user.get_full_name() or self.user.username
 
@@ -122,6 +134,20 @@ class Cita(models.Model):
         help_text="Medicamentos del inventario utilizados durante la atención.",
     )
 
+    class Meta:
+        indexes = [
+            # Respaldan los filtros habituales de los listados de citas.
+            models.Index(fields=["sucursal", "estado", "-fecha_solicitada"]),
+            models.Index(fields=["veterinario", "-fecha_hora"]),
+            models.Index(fields=["paciente", "-fecha_hora"]),
+            # Índice parcial para el filtro "sin veterinario asignado".
+            models.Index(
+                fields=["estado"],
+                condition=models.Q(veterinario__isnull=True),
+                name="cita_pending_no_vet",
+            ),
+        ]
+
     def __str__(self):
         veterinario_nombre = (
             self.veterinario.username if self.veterinario else "Sin asignar"
@@ -254,7 +280,11 @@ class CitaFarmaco(models.Model):
 
     class Meta:
         ordering = ["farmaco__nombre"]
-        unique_together = ("cita", "farmaco")
+        constraints = [
+            models.UniqueConstraint(
+                fields=["cita", "farmaco"], name="uniq_citafarmaco"
+            ),
+        ]
 
     def __str__(self):
         return f"{self.cita_id} - {self.farmaco.nombre} ({self.cantidad})"
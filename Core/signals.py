@@ -1,11 +1,15 @@
 from django.apps import apps
 from django.contrib.auth import get_user_model
-from django.db.models.signals import post_save
+from django.core.cache import cache
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 
 
 User = get_user_model()
 
+# Clave compartida con views._sucursales_ordenadas().
+SUCURSALES_CACHE_KEY = "core:sucursales_ordenadas"
+
 
 @receiver(post_save, sender=User)
 def bootstrap_related_profiles(sender, instance, created, **kwargs):
@@ -27,3 +31,11 @@ def bootstrap_related_profiles(sender, instance, created, **kwargs):
                 "direccion": instance.direccion,
             },
         )
+
+
+@receiver(post_save, sender="Core.Sucursal")
+@receiver(post_delete, sender="Core.Sucursal")
+def invalidar_cache_sucursales(sender, **kwargs):
+    """Descarta la lista cacheada de sucursales cuando cambia el catálogo."""
+
+    cache.delete(SUCURSALES_CACHE_KEY)
@@ -2,18 +2,16 @@ from django.conf import settings
 from django.conf.urls.static import static
 from django.contrib import admin
 from django.urls import include, path
-from django.views.generic import RedirectView
 
 urlpatterns = [
     # Admin de Django
     path('admin/', admin.site.urls),
 
-    # App principal
+    # App principal (la raíz la resuelve Core.urls con la landing)
     path('', include('Core.urls')),
-
-    # Redirigir la raíz a login si quieres (opcional)
-    path('', RedirectView.as_view(pattern_name='login', permanent=False)),
-] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
+]
 
 if settings.DEBUG:
+    # En producción media y estáticos los sirve el servidor web, no Django.
+    urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
     urlpatterns += static(settings.STATIC_URL, document_root=settings.BASE_DIR / 'static')